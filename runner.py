@@ -8,41 +8,205 @@ Based on the MP3Tag script by Bugzero
 
 import os
 import re
+import csv
 import json
 import requests
 import argparse
 from pathlib import Path
 from urllib.parse import quote
 import time
+import random
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
 from mutagen import File
 from mutagen.id3 import ID3, TIT2, TPE1, TALB, TDRC, TCOM, TPE2, USLT, TXXX
 from mutagen.mp3 import MP3
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class FetchProfiler:
+    """Collects per-stage cProfile and tracemalloc data for a sample of processed files"""
+    
+    def __init__(self, output_dir='profile', sample_rate=1.0, top_allocations=25):
+        self.output_dir = Path(output_dir)
+        self.sample_rate = sample_rate
+        self.top_allocations = top_allocations
+        self.stats = {}
+        self.allocations = {}
+        self.peaks = {}
+        self.counts = {}
+        self.files_seen = 0
+        self.files_profiled = 0
+        # tracemalloc traces every thread, and from Python 3.12 cProfile does too,
+        # so a capture only runs while no other file is being processed. Unsampled
+        # files share the gate with each other; sampled files take it exclusively.
+        self._gate = threading.Condition()
+        self._capture_owner = None
+        self._capture_depth = 0
+        self._captures_waiting = 0
+        self._active_files = 0
+        self._data_lock = threading.Lock()
+    
+    def should_sample(self):
+        """Decide whether the next file is profiled"""
+        with self._data_lock:
+            self.files_seen += 1
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+    
+    @contextmanager
+    def shared(self):
+        """Process an unsampled file, waiting while a capture is running or queued"""
+        with self._gate:
+            self._gate.wait_for(lambda: self._capture_owner is None and self._captures_waiting == 0)
+            self._active_files += 1
+        try:
+            yield
+        finally:
+            with self._gate:
+                self._active_files -= 1
+                self._gate.notify_all()
+    
+    @contextmanager
+    def _exclusive(self):
+        """Hold the gate so nothing else is processed; reentrant for the owning thread"""
+        owner = threading.get_ident()
+        with self._gate:
+            if self._capture_owner != owner:
+                self._captures_waiting += 1
+                self._gate.wait_for(lambda: self._capture_owner is None and self._active_files == 0)
+                self._captures_waiting -= 1
+                self._capture_owner = owner
+            self._capture_depth += 1
+        try:
+            yield
+        finally:
+            with self._gate:
+                self._capture_depth -= 1
+                if self._capture_depth == 0:
+                    self._capture_owner = None
+                    self._gate.notify_all()
+    
+    @contextmanager
+    def capture(self):
+        """Hold the profiler for every stage of one sampled file"""
+        with self._exclusive():
+            with self._data_lock:
+                self.files_profiled += 1
+            yield
+    
+    @contextmanager
+    def stage(self, name):
+        """Profile the wrapped block as one run of the named stage"""
+        with self._exclusive():
+            profile = cProfile.Profile()
+            # Leave tracing started by -X tracemalloc / PYTHONTRACEMALLOC running
+            owns_tracing = not tracemalloc.is_tracing()
+            if owns_tracing:
+                tracemalloc.start()
+                before = None
+            else:
+                before = tracemalloc.take_snapshot()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                snapshot = tracemalloc.take_snapshot()
+                if owns_tracing:
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                else:
+                    # The process-wide peak is not specific to this stage
+                    peak = None
+                self._record(name, profile, snapshot, before, peak)
+    
+    def _record(self, name, profile, snapshot, before, peak):
+        """Merge one stage capture into the accumulated results"""
+        if before is None:
+            statistics = [(stat.traceback, stat.size, stat.count) for stat in snapshot.statistics('lineno')]
+        else:
+            diffs = snapshot.compare_to(before, 'lineno')
+            statistics = [(diff.traceback, diff.size_diff, diff.count_diff) for diff in diffs if diff.size_diff > 0]
+        # Skipped after grouping: filter_traces() is slow on large snapshots
+        ignored = (tracemalloc.__file__, cProfile.__file__)
+        statistics = [stat for stat in statistics if stat[0][0].filename not in ignored]
+        with self._data_lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+            allocations = self.allocations.setdefault(name, {})
+            for traceback, stat_size, stat_count in statistics:
+                key = str(traceback)
+                size, count = allocations.get(key, (0, 0))
+                allocations[key] = (size + stat_size, count + stat_count)
+            if peak is not None:
+                self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            self.counts[name] = self.counts.get(name, 0) + 1
+    
+    def write_reports(self):
+        """Write <stage>.pstats, <stage>.txt and <stage>_alloc.txt for every profiled stage"""
+        logger.info(f"Profiled {self.files_profiled} of {self.files_seen} files (sample rate {self.sample_rate})")
+        if not self.stats:
+            logger.info("No stages were profiled, nothing to write")
+            return
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        with self._data_lock:
+            for name, stats in self.stats.items():
+                stats.dump_stats(str(self.output_dir / f"{name}.pstats"))
+                with open(self.output_dir / f"{name}.txt", 'w', encoding='utf-8') as f:
+                    f.write(f"Stage: {name} ({self.counts[name]} profiled runs)\n\n")
+                    stream = stats.stream
+                    stats.stream = f
+                    try:
+                        stats.sort_stats('cumulative').print_stats(40)
+                    finally:
+                        stats.stream = stream
+                
+                allocations = sorted(self.allocations[name].items(), key=lambda item: item[1][0], reverse=True)
+                with open(self.output_dir / f"{name}_alloc.txt", 'w', encoding='utf-8') as f:
+                    f.write(f"Stage: {name} ({self.counts[name]} profiled runs)\n")
+                    if name in self.peaks:
+                        f.write(f"Peak traced memory: {self.peaks[name] / 1024:.1f} KiB\n")
+                    else:
+                        f.write("Peak traced memory: n/a (tracemalloc was already tracing; sizes are growth during the stage)\n")
+                    f.write("No other file is processed during a capture, but other threads (e.g. the GUI) still appear here\n\n")
+                    f.write(f"Top {self.top_allocations} allocations still held at end of stage:\n")
+                    for location, (size, count) in allocations[:self.top_allocations]:
+                        f.write(f"{location}: {size / 1024:.1f} KiB in {count} blocks\n")
+        logger.info(f"Wrote profiling reports to {self.output_dir}")
+
 class GeniusLyricsFetcher:
-    def __init__(self, delay=1.0, user_agent=None, keep_sections=True):
+    def __init__(self, delay=1.0, user_agent=None, keep_sections=True, profiler=None):
         self.delay = delay
         self.keep_sections = keep_sections
+        self.profiler = profiler
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': user_agent or 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
         
-    def clean_text_for_url(self, text):
+    @staticmethod
+    def clean_text_for_url(text):
         """Clean text for URL generation (similar to the MP3Tag script)"""
         # Remove special characters and replace spaces with hyphens
         cleaned = re.sub(r'[^\w\s-]', '', text.lower())
         cleaned = re.sub(r'[-\s]+', '-', cleaned)
         return cleaned.strip('-')
     
-    def generate_genius_url(self, artist, title):
+    @staticmethod
+    def generate_genius_url(artist, title):
         """Generate Genius.com URL from artist and title"""
-        artist_clean = self.clean_text_for_url(artist)
-        title_clean = self.clean_text_for_url(title)
+        artist_clean = GeniusLyricsFetcher.clean_text_for_url(artist)
+        title_clean = GeniusLyricsFetcher.clean_text_for_url(title)
         return f"https://genius.com/{artist_clean}-{title_clean}-lyrics"
     
     def extract_json_from_html(self, html_content):
@@ -279,49 +443,75 @@ class GeniusLyricsFetcher:
             logger.error(f"Error updating MP3 metadata for {file_path}: {e}")
             return False
     
+    @staticmethod
+    def make_search_title(title):
+        """Normalize a file's title into the title used for the Genius search"""
+        # Remove apostrophes
+        search_title = title.replace("'", "")
+        # Remove trailing version like V1, V2, v1, v2 (with or without space)
+        search_title = re.sub(r'\s*[Vv][0-9]+$', '', search_title).strip()
+        # Remove "(LQ)" and "(Snippet)" (case insensitive)
+        search_title = re.sub(r'\s*\([Ll][Qq]\)\s*', '', search_title)
+        search_title = re.sub(r'\s*\([Ss]nippet\)\s*', '', search_title, flags=re.IGNORECASE)
+        # Remove (OG) (case insensitive)
+        search_title = re.sub(r'\s*\([Oo][Gg]\)\s*', '', search_title, flags=re.IGNORECASE)
+        # Remove (feat. ...) and (with ...) (case-insensitive)
+        search_title = re.sub(r'\s*\((feat\.|with)[^)]*\)', '', search_title, flags=re.IGNORECASE)
+        # Split by "/" and use only the first part
+        search_title = search_title.split('/')[0].strip()
+        return search_title
+    
+    def profile_stage(self, name, sampled=True):
+        """Context manager profiling a stage when a profiler is attached and the file is sampled"""
+        if self.profiler is None or not sampled:
+            return nullcontext()
+        return self.profiler.stage(name)
+    
     def process_file(self, file_path, force_update=False):
         """Process a single MP3 file"""
+        if self.profiler is None:
+            return self._process_file(file_path, force_update, False)
+        sampled = self.profiler.should_sample()
+        if not sampled:
+            with self.profiler.shared():
+                return self._process_file(file_path, force_update, sampled)
+        with self.profiler.capture():
+            return self._process_file(file_path, force_update, sampled)
+    
+    def _process_file(self, file_path, force_update, sampled):
+        """Process a single MP3 file, profiling each stage when sampled"""
         try:
-            # Get existing metadata
-            existing_metadata = self.get_mp3_metadata(file_path)
-            if not existing_metadata:
-                logger.warning(f"Could not read metadata from {file_path}")
-                return False
-            artist = existing_metadata.get('artist', '')
-            title = existing_metadata.get('title', '')
-            if not artist or not title:
-                logger.warning(f"Missing artist or title in {file_path}")
-                return False
-            # Remove apostrophes
-            search_title = title.replace("'", "")
-            # Remove trailing version like V1, V2, v1, v2 (with or without space)
-            search_title = re.sub(r'\s*[Vv][0-9]+$', '', search_title).strip()
-            # Remove "(LQ)" and "(Snippet)" (case insensitive)
-            search_title = re.sub(r'\s*\([Ll][Qq]\)\s*', '', search_title)
-            search_title = re.sub(r'\s*\([Ss]nippet\)\s*', '', search_title, flags=re.IGNORECASE)
-            # Remove (OG) (case insensitive)
-            search_title = re.sub(r'\s*\([Oo][Gg]\)\s*', '', search_title, flags=re.IGNORECASE)
-            # Remove (feat. ...) and (with ...) (case-insensitive)
-            search_title = re.sub(r'\s*\((feat\.|with)[^)]*\)', '', search_title, flags=re.IGNORECASE)
-            # Split by "/" and use only the first part
-            search_title = search_title.split('/')[0].strip()
-            if search_title != title:
-                logger.info(f"Title '{title}' -> Using '{search_title}' for search")
-            # Check if lyrics already exist and we're not forcing update
-            if not force_update:
-                audio = MP3(file_path, ID3=ID3)
-                if audio.tags and 'USLT::eng' in audio.tags:
-                    logger.info(f"Lyrics already exist in {file_path}, skipping")
-                    return True
-            # Fetch new metadata using the search title
-            genius_metadata = self.fetch_lyrics_and_metadata(artist, search_title)
-            if not genius_metadata:
-                logger.warning(f"Could not fetch metadata for {artist} - {search_title}")
-                return False
+            with self.profile_stage('read_tags', sampled):
+                # Get existing metadata
+                existing_metadata = self.get_mp3_metadata(file_path)
+                if not existing_metadata:
+                    logger.warning(f"Could not read metadata from {file_path}")
+                    return False
+                artist = existing_metadata.get('artist', '')
+                title = existing_metadata.get('title', '')
+                if not artist or not title:
+                    logger.warning(f"Missing artist or title in {file_path}")
+                    return False
+                search_title = self.make_search_title(title)
+                if search_title != title:
+                    logger.info(f"Title '{title}' -> Using '{search_title}' for search")
+                # Check if lyrics already exist and we're not forcing update
+                if not force_update:
+                    audio = MP3(file_path, ID3=ID3)
+                    if audio.tags and 'USLT::eng' in audio.tags:
+                        logger.info(f"Lyrics already exist in {file_path}, skipping")
+                        return True
+            with self.profile_stage('fetch', sampled):
+                # Fetch new metadata using the search title
+                genius_metadata = self.fetch_lyrics_and_metadata(artist, search_title)
+                if not genius_metadata:
+                    logger.warning(f"Could not fetch metadata for {artist} - {search_title}")
+                    return False
             # Always use the original file's title for tagging
             genius_metadata['title'] = title
             # Update the file (only lyrics and year)
-            success = self.update_mp3_metadata(file_path, genius_metadata)
+            with self.profile_stage('write_tags', sampled):
+                success = self.update_mp3_metadata(file_path, genius_metadata)
             if success:
                 logger.info(f"Successfully updated {file_path}")
             return success
@@ -336,7 +526,8 @@ class GeniusLyricsFetcher:
             logger.error(f"Directory does not exist: {directory_path}")
             return
         
-        mp3_files = list(directory.rglob("*.mp3"))
+        with self.profile_stage('scan'):
+            mp3_files = list(directory.rglob("*.mp3"))
         if not mp3_files:
             logger.info(f"No MP3 files found in {directory_path}")
             return
@@ -354,27 +545,196 @@ class GeniusLyricsFetcher:
         
         logger.info(f"Processing complete: {successful} successful, {failed} failed")
 
+def is_valid_timestamp(frame):
+    """Check that every timestamp in a TDRC frame parsed into a real date/time"""
+    if not frame.text:
+        return False
+    for stamp in frame.text:
+        # mutagen keeps unparseable text as an ID3TimeStamp with no year
+        if stamp.year is None:
+            return False
+        try:
+            datetime(stamp.year, stamp.month or 1, stamp.day or 1,
+                     stamp.hour or 0, stamp.minute or 0, stamp.second or 0)
+        except ValueError:
+            return False
+    return True
+
+def audit_file(file_path):
+    """Read the tags of a single MP3 file for an audit (no network access)"""
+    result = {
+        'path': file_path,
+        'readable': True,
+        'artist': '',
+        'title': '',
+        'year': '',
+        'has_lyrics': False,
+        'missing_artist_or_title': False,
+        'missing_year': False,
+        'bad_year': False,
+        'will_fetch': False,
+        'search_key': '',
+    }
+    try:
+        # Same read as get_mp3_metadata, so files process_file cannot open are unreadable here too
+        audio = MP3(file_path, ID3=ID3)
+        tags = audio.tags if audio.tags is not None else {}
+    except Exception as e:
+        logger.error(f"Error reading MP3 metadata from {file_path}: {e}")
+        result['readable'] = False
+        return result
+    
+    result['artist'] = str(tags['TPE1'][0]) if 'TPE1' in tags and tags['TPE1'].text else ''
+    result['title'] = str(tags['TIT2'][0]) if 'TIT2' in tags and tags['TIT2'].text else ''
+    result['year'] = str(tags['TDRC'][0]) if 'TDRC' in tags and tags['TDRC'].text else ''
+    result['has_lyrics'] = 'USLT::eng' in tags
+    result['missing_artist_or_title'] = not result['artist'] or not result['title']
+    result['missing_year'] = 'TDRC' not in tags
+    result['bad_year'] = 'TDRC' in tags and not is_valid_timestamp(tags['TDRC'])
+    
+    if not result['missing_artist_or_title']:
+        search_title = GeniusLyricsFetcher.make_search_title(result['title'])
+        result['search_key'] = GeniusLyricsFetcher.generate_genius_url(result['artist'], search_title)
+    return result
+
+def would_fetch(result, force_update=False):
+    """Whether process_file would fetch from Genius for an audited file"""
+    # Mirrors the skip/fail decisions made by process_file
+    return (
+        result['readable']
+        and not result['missing_artist_or_title']
+        and (force_update or not result['has_lyrics'])
+    )
+
+def summarize_audit(results, force_update=False):
+    """Summarize audit results into the expected work for a fetch run"""
+    readable = [r for r in results if r['readable']]
+    to_fetch = [r for r in readable if would_fetch(r, force_update)]
+    unique_keys = {r['search_key'] for r in to_fetch}
+    return {
+        'total_files': len(results),
+        'unreadable': len(results) - len(readable),
+        'missing_lyrics': sum(1 for r in readable if not r['has_lyrics']),
+        'missing_artist_or_title': sum(1 for r in readable if r['missing_artist_or_title']),
+        'missing_year': sum(1 for r in readable if r['missing_year']),
+        'bad_year': sum(1 for r in readable if r['bad_year']),
+        'files_to_fetch': len(to_fetch),
+        'unique_search_keys': len(unique_keys),
+        'duplicate_fetches': len(to_fetch) - len(unique_keys),
+        'dedup_ratio': round(len(unique_keys) / len(to_fetch), 4) if to_fetch else 1.0,
+    }
+
+def write_audit_report(report_path, results, summary):
+    """Write audit results to a CSV (one row per file, summary in <name>.summary.json) or JSON report"""
+    report_path = Path(report_path)
+    if report_path.suffix.lower() == '.csv':
+        fieldnames = list(results[0].keys()) if results else ['path']
+        with open(report_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+        summary_path = report_path.with_suffix('.summary.json')
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Wrote audit summary to {summary_path}")
+    else:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'files': results}, f, indent=2, ensure_ascii=False)
+    logger.info(f"Wrote audit report to {report_path}")
+
+def audit_directory(directory_path, workers=None, force_update=False):
+    """Audit tags of all MP3 files under a path using a process pool"""
+    path = Path(directory_path)
+    if path.is_file():
+        # Same check as main() applies before a fetch run
+        if path.suffix.lower() != '.mp3':
+            logger.error("File is not an MP3 file")
+            return [], summarize_audit([], force_update)
+        mp3_files = [str(path)]
+    else:
+        mp3_files = [str(p) for p in path.rglob("*.mp3")]
+    if not mp3_files:
+        logger.info(f"No MP3 files found in {directory_path}")
+        return [], summarize_audit([], force_update)
+    
+    logger.info(f"Auditing {len(mp3_files)} MP3 files")
+    workers = workers or os.cpu_count() or 1
+    # Large chunks keep inter-process overhead low on libraries with 100k+ files
+    chunksize = max(1, min(500, len(mp3_files) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(audit_file, mp3_files, chunksize=chunksize))
+    for result in results:
+        result['will_fetch'] = would_fetch(result, force_update)
+        # Only files that would be fetched carry a key, so grouping the report reproduces the dedup figures
+        if not result['will_fetch']:
+            result['search_key'] = ''
+    return results, summarize_audit(results, force_update)
+
+def audit_main(args):
+    """Run an audit for parsed --audit command line arguments"""
+    if not Path(args.path).exists():
+        logger.error(f"Path does not exist: {args.path}")
+        return
+    
+    start = time.time()
+    results, summary = audit_directory(args.path, args.workers, args.force)
+    elapsed = time.time() - start
+    
+    print(f"Audit of {args.path} ({elapsed:.1f}s)")
+    print(f"  Total files:             {summary['total_files']}")
+    print(f"  Unreadable:              {summary['unreadable']}")
+    print(f"  Missing lyrics:          {summary['missing_lyrics']}")
+    print(f"  Missing artist or title: {summary['missing_artist_or_title']}")
+    print(f"  Missing year (TDRC):     {summary['missing_year']}")
+    print(f"  Bad year (TDRC):         {summary['bad_year']}")
+    print(f"  Files to fetch:          {summary['files_to_fetch']}")
+    print(f"  Unique search keys:      {summary['unique_search_keys']}")
+    print(f"  Dedup ratio:             {summary['dedup_ratio']}")
+    
+    write_audit_report(args.report, results, summary)
+
 def main():
     parser = argparse.ArgumentParser(description='Genius Lyrics Fetcher - Batch MP3 metadata updater')
     parser.add_argument('path', help='Path to MP3 file or directory')
-    parser.add_argument('--force', '-f', action='store_true', help='Force update even if lyrics already exist')
+    parser.add_argument('--force', '-f', action='store_true', help='Force update even if lyrics already exist (with --audit, estimate a forced run)')
     parser.add_argument('--delay', '-d', type=float, default=1.0, help='Delay between requests in seconds (default: 1.0)')
     parser.add_argument('--user-agent', '-u', help='Custom User-Agent string')
+    parser.add_argument('--profile', action='store_true', help='Profile processing stages with cProfile and tracemalloc')
+    parser.add_argument('--profile-dir', default='profile', help='Directory for profiling reports (default: profile)')
+    parser.add_argument('--profile-sample', type=float, default=1.0, help='Fraction of files to profile, 0.0-1.0 (default: 1.0)')
+    
+    parser.add_argument('--audit', action='store_true', help='Audit tags and estimate fetch work without network access')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='Number of audit worker processes (default: CPU count)')
+    parser.add_argument('--report', '-r', default='audit_report.json', help='Audit report file; .csv writes one row per file plus <name>.summary.json, otherwise JSON (default: audit_report.json)')
     
     args = parser.parse_args()
+    if not 0 < args.profile_sample <= 1:
+        parser.error("--profile-sample must be greater than 0 and at most 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    
+    if args.audit:
+        audit_main(args)
+        return
     
-    fetcher = GeniusLyricsFetcher(delay=args.delay, user_agent=args.user_agent)
+    profiler = FetchProfiler(args.profile_dir, args.profile_sample) if args.profile else None
+    fetcher = GeniusLyricsFetcher(delay=args.delay, user_agent=args.user_agent, profiler=profiler)
     
     path = Path(args.path)
-    if path.is_file():
-        if path.suffix.lower() == '.mp3':
-            fetcher.process_file(str(path), args.force)
+    try:
+        if path.is_file():
+            if path.suffix.lower() == '.mp3':
+                fetcher.process_file(str(path), args.force)
+            else:
+                logger.error("File is not an MP3 file")
+        elif path.is_dir():
+            fetcher.process_directory(str(path), args.force)
         else:
-            logger.error("File is not an MP3 file")
-    elif path.is_dir():
-        fetcher.process_directory(str(path), args.force)
-    else:
-        logger.error(f"Path does not exist: {args.path}")
+            logger.error(f"Path does not exist: {args.path}")
+    finally:
+        # Keep whatever was captured when a long run is interrupted
+        if profiler:
+            profiler.write_reports()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
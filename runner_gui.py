@@ -10,7 +10,7 @@ import threading
 import queue
 import os
 from pathlib import Path
-from genius_lyrics_fetcher import GeniusLyricsFetcher
+from genius_lyrics_fetcher import GeniusLyricsFetcher, FetchProfiler
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -36,6 +36,8 @@ class GeniusLyricsGUI:
         self.delay_var = tk.DoubleVar(value=1.0)
         self.thread_var = tk.IntVar(value=1)
         self.section_format_var = tk.BooleanVar(value=True)
+        self.profile_var = tk.BooleanVar()
+        self.profile_sample_var = tk.DoubleVar(value=1.0)
         
         self.create_widgets()
         self.update_log()
@@ -99,6 +101,10 @@ class GeniusLyricsGUI:
         thread_spin = ttk.Spinbox(options_frame, from_=1, to=10, increment=1, textvariable=self.thread_var, width=10)
         thread_spin.grid(row=2, column=1, sticky="w", padx=(5, 0), pady=2)
         ttk.Checkbutton(options_frame, text="Keep section headers ([Chorus], [Verse], etc.)", variable=self.section_format_var).grid(row=3, column=0, columnspan=2, sticky="w", pady=2)
+        ttk.Checkbutton(options_frame, text="Profile run (reports written to ./profile)", variable=self.profile_var).grid(row=4, column=0, columnspan=2, sticky="w", pady=2)
+        ttk.Label(options_frame, text="Fraction of files to profile:").grid(row=5, column=0, sticky="w", pady=2)
+        profile_sample_spin = ttk.Spinbox(options_frame, from_=0.01, to=1.0, increment=0.05, textvariable=self.profile_sample_var, width=10)
+        profile_sample_spin.grid(row=5, column=1, sticky="w", padx=(5, 0), pady=2)
 
         # Action Buttons (row 2)
         button_frame = ttk.Frame(main_frame)
@@ -184,6 +190,15 @@ class GeniusLyricsGUI:
             messagebox.showerror("Error", "Selected path does not exist.")
             return
         
+        if self.profile_var.get():
+            try:
+                sample_rate = self.profile_sample_var.get()
+            except tk.TclError:
+                sample_rate = 0
+            if not 0 < sample_rate <= 1:
+                messagebox.showerror("Error", "Fraction of files to profile must be greater than 0 and at most 1.")
+                return
+        
         self.processing = True
         self.failed_files = []
         self.start_button.config(state='disabled')
@@ -202,10 +217,14 @@ class GeniusLyricsGUI:
     
     def process_files(self, path):
         """Process files in a separate thread"""
+        profiler = None
         try:
+            if self.profile_var.get():
+                profiler = FetchProfiler(sample_rate=self.profile_sample_var.get())
             fetcher = GeniusLyricsFetcher(
                 delay=self.delay_var.get(),
-                keep_sections=self.section_format_var.get()
+                keep_sections=self.section_format_var.get(),
+                profiler=profiler
             )
             
             # Process based on path type
@@ -217,6 +236,11 @@ class GeniusLyricsGUI:
         except Exception as e:
             logging.error(f"Processing error: {e}")
         finally:
+            if profiler:
+                try:
+                    profiler.write_reports()
+                except Exception as e:
+                    logging.error(f"Error writing profiling reports: {e}")
             self.root.after(0, self.processing_finished)
     
     def process_single_file(self, fetcher, file_path):
@@ -240,7 +264,8 @@ class GeniusLyricsGUI:
     def process_directory(self, fetcher, directory_path):
         """Process all MP3 files in a directory"""
         directory = Path(directory_path)
-        mp3_files = list(directory.rglob("*.mp3"))
+        with fetcher.profile_stage('scan'):
+            mp3_files = list(directory.rglob("*.mp3"))
         if not mp3_files:
             logging.warning(f"No MP3 files found in {directory_path}")
             return